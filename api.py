@@ -1,17 +1,58 @@
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, TypeAdapter
 from typing import List, Dict, Optional, Any
-from sequence_executor import SequenceExecutor
+from contextlib import asynccontextmanager, aclosing
+from collections import deque
+from sequence_executor import SequenceExecutor, MAX_LOG_LINES
 import logging
+import orjson
+import os
 import sys
 import asyncio
 
-# Enforce ProactorEventLoop on Windows for Playwright
+# Enforce ProactorEventLoop on Windows for Playwright, uvloop everywhere else
+UVLOOP_ENABLED = False
 if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
+else:
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        UVLOOP_ENABLED = True
+    except ImportError:
+        logging.warning("⚠️ uvloop not installed. Falling back to the default asyncio loop.")
+
+# Max number of executions (requests) running at the same time on the shared Browser.
+# Each one holds its own context, plus one extra per sequence while a parallel_group runs.
+MAX_CONCURRENT_EXECUTIONS = int(os.getenv("MAX_CONCURRENT_EXECUTIONS", "4"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Runs once per process: starts the shared browser on startup
+    and tears it down on shutdown.
+    """
+    loop = asyncio.get_running_loop()
+    logging.info(f"🚀 API Startup. Event Loop: {type(loop)}")
+    if sys.platform == "win32" and not isinstance(loop, asyncio.ProactorEventLoop):
+        logging.warning("⚠️ WARNING: Not running on ProactorEventLoop! Playwright may fail.")
+
+    app.state.execution_slots = asyncio.Semaphore(MAX_CONCURRENT_EXECUTIONS)
+    try:
+        await SequenceExecutor.get_browser()
+        logging.info(f"🌐 Max {MAX_CONCURRENT_EXECUTIONS} concurrent executions.")
+    except Exception as e:
+        # The first request retries the launch
+        logging.error(f"❌ Failed to start shared browser: {e}")
+
+    yield
+
+    await SequenceExecutor.close_browser()
+    logging.info("🛑 Shared browser closed.")
 
 # Initialize FastAPI app
-app = FastAPI(title="Orvi-Agent Sequence Executor API", version="1.0.0")
+app = FastAPI(title="Orvi-Agent Sequence Executor API", version="1.0.0", lifespan=lifespan)
 
 # --- Data Models ---
 
@@ -25,6 +66,7 @@ class StepModel(BaseModel):
     wait_after: int = 1
     optional: bool = False
     lookup_source: Optional[str] = None
+    defer: bool = False
 
 class SequenceModel(BaseModel):
     """
@@ -34,8 +76,13 @@ class SequenceModel(BaseModel):
     intents_number: int = 1
     target_element: Optional[str] = None
     target_element_wait: int = 0
+    persist_session: bool = False
+    parallel_group: Optional[str] = None
     steps: List[StepModel]
 
+# Pre-built serializer: dumps the whole validated list in one call
+SEQUENCES_ADAPTER = TypeAdapter(List[SequenceModel])
+
 class ExecutionRequest(BaseModel):
     """
     The payload expected by the /execute endpoint.
@@ -53,40 +100,66 @@ class ExecutionResponse(BaseModel):
 
 # --- Endpoints ---
 
-@app.post("/execute", response_model=ExecutionResponse)
-async def execute_sequence(request: ExecutionRequest):
+async def execution_events(request: ExecutionRequest):
     """
-    Executes a list of sequences provided in the payload.
-    Returns the execution result, logs, and a screenshot filename.
+    Runs the requested sequences and yields the executor's events
+    ({"log": ...} lines, then a final {"result": ...}).
     """
     logging.info(f"🚀 Received execution request with {len(request.sequences)} sequences.")
     
+    # Reuse the warm Browser; each request only pays for a new BrowserContext
     executor = SequenceExecutor()
     
-    # Convert Pydantic models to list of dicts/dicts expected by Executor
-    # The models are compatible, but we can dump them to dicts to be safe 
-    # and consistent with existing logic.
-    sequences_data = [seq.model_dump() for seq in request.sequences]
+    # Convert the already-validated models to the dicts expected by Executor.
+    # Unset optionals are dropped; the executor's .get() defaults cover them.
+    sequences_data = SEQUENCES_ADAPTER.dump_python(request.sequences, exclude_none=True)
     coordinates_data = request.coordinates
     
+    # aclosing: the stream's teardown runs before the slot is released, even if this generator is closed early
+    async with app.state.execution_slots, aclosing(executor.execute_stream(sequences_data, coordinates_data)) as events:
+        async for event in events:
+            yield event
+
+@app.post("/execute", response_model=ExecutionResponse)
+async def execute_sequence(request: ExecutionRequest):
+    """
+    Executes a list of sequences provided in the payload.
+    Returns the execution result, logs, and a screenshot filename.
+    """
+    logs = deque(maxlen=MAX_LOG_LINES)
     try:
-        result = await executor.execute(sequences_data, coordinates_data)
-        return ExecutionResponse(**result)
+        async for event in execution_events(request):
+            if "log" in event:
+                logs.append(event["log"])
+            else:
+                result = event["result"]
+        return ExecutionResponse(logs=list(logs), **result)
     except Exception as e:
         error_msg = f"🔥 API CRITICAL ERROR: {str(e)}"
         logging.error(error_msg)
         return ExecutionResponse(
             success=False,
-            logs=[error_msg],
+            logs=list(logs) + [error_msg],
             screenshot=None
         )
 
-@app.on_event("startup")
-async def startup_event():
-    loop = asyncio.get_running_loop()
-    logging.info(f"🚀 API Startup. Event Loop: {type(loop)}")
-    if sys.platform == "win32" and not isinstance(loop, asyncio.ProactorEventLoop):
-        logging.warning("⚠️ WARNING: Not running on ProactorEventLoop! Playwright may fail.")
+@app.post("/execute/stream")
+async def execute_sequence_stream(request: ExecutionRequest):
+    """
+    Same as /execute, but streams NDJSON: one {"log": ...} line per log entry
+    as it happens, then a final {"result": {"success": ..., "screenshot": ...}} line.
+    """
+    async def ndjson():
+        try:
+            async for event in execution_events(request):
+                yield orjson.dumps(event) + b"\n"
+        except Exception as e:
+            error_msg = f"🔥 API CRITICAL ERROR: {str(e)}"
+            logging.error(error_msg)
+            yield orjson.dumps({"log": error_msg}) + b"\n"
+            yield orjson.dumps({"result": {"success": False, "screenshot": None}}) + b"\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
 
 @app.get("/health")
 def health_check():
@@ -100,7 +173,10 @@ if __name__ == "__main__":
     parser.add_argument("--port", type=int, default=8000, help="Port to run the API on")
     args = parser.parse_args()
 
-    if sys.platform == "win32":
-        asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
-    
-    uvicorn.run(app, host="0.0.0.0", port=args.port)
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=args.port,
+        loop="uvloop" if UVLOOP_ENABLED else "asyncio",
+        http="httptools"
+    )
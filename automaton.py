@@ -1,6 +1,8 @@
 import asyncio
 import base64
-import json
+import hashlib
+import io
+import orjson
 import os
 import time
 from typing import List, Dict, Any, Optional
@@ -13,7 +15,8 @@ import logging
 import sys
 import os
 import time
-from PIL import Image, ImageOps, ImageEnhance
+import numpy as np
+from PIL import Image, ImageOps
 from anticaptchaofficial.imagecaptcha import imagecaptcha
 
 # Forzar UTF-8 en consola para Windows
@@ -38,6 +41,9 @@ GENAI_API_KEY = os.getenv("GOOGLE_API_KEY")
 if not GENAI_API_KEY:
     logging.info("WARNING: GOOGLE_API_KEY not found in .env")
 
+# Cliente compartido: reutiliza el pool de conexiones HTTP entre instancias de Oracle
+_GENAI_CLIENT = genai.Client(api_key=GENAI_API_KEY) if GENAI_API_KEY else None
+
 # Configurar Anti-Captcha
 ANTICAPTCHA_API_KEY = os.getenv("ANTICAPTCHA_API_KEY")
 if not ANTICAPTCHA_API_KEY:
@@ -45,10 +51,34 @@ if not ANTICAPTCHA_API_KEY:
 
 # Removed genai.configure, now using Client
 
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+def _write_file(path: str, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+
+def _bulk_delete(paths: List[str]):
+    """Borra varios archivos ignorando los que ya no existen."""
+    for path in paths:
+        try:
+            os.unlink(path)
+            logging.info(f"   Deleted {path}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.error(f"   Failed to delete {path}: {e}")
+
+# Capturas de página en JPEG (los captchas siguen en PNG, sin pérdida)
+SCREENSHOT_QUALITY = 70
+
 class Oracle:
     """Maneja la validación visual usando Gemini 1.5 Flash (New SDK)."""
     def __init__(self, model_name: str = "gemini-2.5-flash"):
-        self.client = genai.Client(api_key=GENAI_API_KEY)
+        if _GENAI_CLIENT is None:
+            raise ValueError("GOOGLE_API_KEY is required to use the Oracle")
+        self.client = _GENAI_CLIENT
         self.model_name = model_name
 
     async def validate(self, screenshot_path: str, prompt: str) -> Dict[str, Any]:
@@ -59,13 +89,24 @@ class Oracle:
         if not prompt:
             return {"passed": True, "reason": "No validation prompt provided."}
 
-        logging.info(f"🔮 Oracle: Validando '{prompt}'...")
-        
         try:
-            # Leer imagen
-            with open(screenshot_path, "rb") as image_file:
-                image_data = image_file.read()
+            # Leer imagen fuera del event loop
+            image_data = await asyncio.to_thread(_read_file, screenshot_path)
+        except Exception as e:
+            logging.info(f"❌ Oracle Error: {e}")
+            return {"passed": False, "reason": f"Error reading screenshot: {e}"}
+
+        return await self.validate_bytes(image_data, prompt)
 
+    async def validate_bytes(self, image_data: bytes, prompt: str) -> Dict[str, Any]:
+        """
+        Igual que validate, pero con la imagen ya en memoria.
+        """
+        if not prompt:
+            return {"passed": True, "reason": "No validation prompt provided."}
+
+        logging.info(f"🔮 Oracle: Validando '{prompt}'...")
+        try:
             # Prepare content
             # prompt_text is part of the content
             prompt_text = f"""
@@ -77,15 +118,11 @@ class Oracle:
             }}
             """
 
-            # Use async call via asyncio.to_thread if async client is not clear, 
-            # OR use client.aio.models.generate_content if available.
-            # Safe bet: wrap sync call
-            
-            response = await asyncio.to_thread(
-                self.client.models.generate_content,
+            # Native async client (httpx), no thread pool hop
+            response = await self.client.aio.models.generate_content(
                 model=self.model_name,
                 contents=[
-                    types.Part.from_bytes(data=image_data, mime_type="image/png"),
+                    types.Part.from_bytes(data=image_data, mime_type="image/jpeg"),
                     prompt_text
                 ],
                 config=types.GenerateContentConfig(
@@ -93,7 +130,7 @@ class Oracle:
                 )
             )
             
-            result = json.loads(response.text)
+            result = orjson.loads(response.text)
             logging.info(f"🔮 Oracle Verdict: {result.get('passed')} - {result.get('reason')}")
             return result
 
@@ -105,13 +142,11 @@ class Oracle:
         """Extrae texto de una imagen (para captchas)."""
         logging.info(f"🔮 Oracle: Extrayendo texto de {screenshot_path}...")
         try:
-            with open(screenshot_path, "rb") as image_file:
-                image_data = image_file.read()
+            image_data = await asyncio.to_thread(_read_file, screenshot_path)
 
             prompt_text = "Analyze this image. It contains a login form with a captcha. Locate the captcha characters (alphanumeric, ignore strikethrough lines). Return ONLY the exact characters string (e.g. 'Ab3d'). No spaces, no JSON, no markdown. If the image is the form, find the captcha inside it."
 
-            response = await asyncio.to_thread(
-                self.client.models.generate_content,
+            response = await self.client.aio.models.generate_content(
                 model=self.model_name,
                 contents=[
                     types.Part.from_bytes(data=image_data, mime_type="image/png"),
@@ -131,56 +166,104 @@ class CaptchaSolver:
     """Maneja la resolución de captchas usando Anti-Captcha."""
     def __init__(self):
         self.api_key = ANTICAPTCHA_API_KEY
-
-    def solve_image(self, image_path: str) -> str:
-        if not self.api_key:
+        # Se configura una sola vez y se reutiliza en cada captcha
+        self.solver = None
+        if self.api_key:
+            self.solver = imagecaptcha()
+            self.solver.set_verbose(1)
+            self.solver.set_key(self.api_key)
+
+    def solve_image(self, image_data: bytes) -> str:
+        if not self.solver:
             logging.error("❌ No Anti-Captcha API Key provided.")
             return ""
 
-        logging.info(f"🧩 Sending {image_path} to Anti-Captcha...")
-        solver = imagecaptcha()
-        solver.set_verbose(1)
-        solver.set_key(self.api_key)
+        logging.info(f"🧩 Sending captcha image ({len(image_data)} bytes) to Anti-Captcha...")
         
         try:
-            captcha_text = solver.solve_and_return_solution(image_path)
+            # Sin archivo: el SDK codifica en base64 los bytes recibidos en 'body'
+            captcha_text = self.solver.solve_and_return_solution(None, body=image_data)
             if captcha_text != 0:
                 logging.info(f"✅ Anti-Captcha Solved: '{captcha_text}'")
                 return captcha_text
             else:
-                logging.error(f"❌ Anti-Captcha Failed: {solver.error_code}")
+                logging.error(f"❌ Anti-Captcha Failed: {self.solver.error_code}")
                 return ""
         except Exception as e:
             logging.error(f"❌ Anti-Captcha Exception: {e}")
             return ""
 
+# Sesión autenticada (cookies/localStorage) reutilizada entre ejecuciones, un archivo por identidad
+SESSION_STATE_DIR = os.getenv("SESSION_STATE_DIR", "sessions")
+SESSION_TTL = int(os.getenv("SESSION_TTL", "900")) # segundos
+
+def session_state_path(identity: str) -> str:
+    """Archivo de sesión de una identidad; el nombre es un hash para no exponer credenciales."""
+    digest = hashlib.sha256(identity.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(SESSION_STATE_DIR, f"session_{digest}.json")
+
+def _is_fresh(path: str, ttl: int) -> bool:
+    try:
+        return time.time() - os.path.getmtime(path) < ttl
+    except OSError:
+        return False
+
+async def launch_browser(playwright) -> Browser:
+    """Lanza el navegador con la configuración del agente."""
+    # Si hay un Chrome compartido (CHROME_CDP_URL), conectarse a él en vez de lanzar otro
+    cdp_url = os.getenv("CHROME_CDP_URL")
+    if cdp_url:
+        logging.info(f"🔌 Connecting to shared Chrome at {cdp_url}...")
+        return await playwright.chromium.connect_over_cdp(cdp_url)
+
+    # Headless por defecto; HEADLESS=false para ver el navegador y posibles captchas
+    # SLOW_MO=100 ralentiza cada operación de Playwright 100ms (solo para depurar)
+    return await playwright.chromium.launch(
+        channel="chrome",
+        headless=os.getenv("HEADLESS", "true").lower() == "true",
+        slow_mo=int(os.getenv("SLOW_MO", "0")),
+        args=["--disable-features=Translate", "--disable-translate"]
+    )
+
 class PlaywrightEngine:
     """Maneja las interacciones con el navegador."""
-    def __init__(self):
+    def __init__(self, browser: Optional[Browser] = None):
+        # Si se recibe un Browser externo, solo se gestiona el contexto/página propios
         self.playwright = None
-        self.browser = None
+        self.browser = browser
+        self.owns_browser = browser is None
         self.context = None
         self.page = None
         self.captcha_solver = CaptchaSolver()
         self.output_dir = "screenshots"
         self.generated_files = []
+        self._pending_captcha = None # (input_selector, Task) de un captcha resolviéndose en segundo plano
+        self._env_cache: Dict[str, str] = {} # Variables 'env:' ya resueltas en esta ejecución
+        self.session_restored = False
+        self.session_file = None # Archivo de sesión restaurado en start(), si lo hubo
 
-    async def start(self):
-        if not os.path.exists(self.output_dir):
-            os.makedirs(self.output_dir)
+    async def start(self, storage_state: Optional[Any] = None, session_file: Optional[str] = None):
+        """
+        Abre el contexto y la página. 'storage_state' permite heredar la
+        sesión de otro contexto; si no, se restaura 'session_file' (si se indica y sigue vigente).
+        """
+        await asyncio.to_thread(os.makedirs, self.output_dir, exist_ok=True)
         
-        self.playwright = await async_playwright().start()
-        # Headless=False para ver el navegador y posibles captchas
-        # slow_mo=100 ralentiza cada operación de Playwright 100ms
-        self.browser = await self.playwright.chromium.launch(
-            channel="chrome",
-            headless=False, 
-            slow_mo=100,
-            args=["--disable-features=Translate", "--disable-translate"]
-        )
+        if self.owns_browser:
+            self.playwright = await async_playwright().start()
+            self.browser = await launch_browser(self.playwright)
+
+        # Restaurar la sesión guardada solo si se pidió y aún está dentro del TTL
+        if storage_state is None and session_file and _is_fresh(session_file, SESSION_TTL):
+            logging.info(f"🍪 Restoring browser session from {session_file}")
+            storage_state = session_file
+            self.session_restored = True
+            self.session_file = session_file
+
         self.context = await self.browser.new_context(
             permissions=[], # Block all permissions by default (or empty list blocks geo if not granted)
-            geolocation={"latitude": 18.4861, "longitude": -69.9312} # Fake Santo Domingo just in case
+            geolocation={"latitude": 18.4861, "longitude": -69.9312}, # Fake Santo Domingo just in case
+            storage_state=storage_state
         )
         # Explicitly clear permissions to be safe, or just relying on default deny.
         # Better: Grant 'geolocation' if we wanted it, but to BLOCK it, we just don't grant it. 
@@ -194,15 +277,53 @@ class PlaywrightEngine:
 
 
     async def stop(self):
+        self.cancel_pending_captcha()
         if self.context: await self.context.close()
-        if self.browser: await self.browser.close()
-        if self.playwright: await self.playwright.stop()
+        if self.owns_browser:
+            if self.browser: await self.browser.close()
+            if self.playwright: await self.playwright.stop()
+
+    async def save_session(self, session_file: str):
+        """Guarda cookies/localStorage del contexto para reutilizar el login."""
+        await asyncio.to_thread(os.makedirs, os.path.dirname(session_file) or ".", exist_ok=True)
+        await self.context.storage_state(path=session_file)
+        logging.info(f"🍪 Browser session saved to {session_file}")
+
+    async def discard_session(self):
+        """Borra el archivo de sesión restaurado (p.ej. cuando ya no es válido)."""
+        if self.session_file:
+            await asyncio.to_thread(_bulk_delete, [self.session_file])
+            self.session_file = None
+        self.session_restored = False
+
+    async def await_captcha(self):
+        """Espera el captcha pendiente (si lo hay) y escribe su solución."""
+        if not self._pending_captcha:
+            return
+        input_selector, solve_task = self._pending_captcha
+        self._pending_captcha = None
+
+        captcha_text = await solve_task
+        if captcha_text:
+            await self.page.fill(input_selector, captcha_text)
+        else:
+            logging.error("⚠️ Failed to solve captcha (Text is empty/0). Raising exception to trigger retry.")
+            raise Exception("Captcha Solve Failed")
+
+    def cancel_pending_captcha(self):
+        """Descarta un captcha pendiente (p.ej. al reintentar o cerrar)."""
+        if self._pending_captcha:
+            self._pending_captcha[1].cancel()
+            self._pending_captcha = None
 
     def _resolve_value(self, value: str) -> str:
         """Resuelve valores como 'env:VAR_NAME'."""
         if value.startswith("env:"):
-            env_var = value.split(":", 1)[1]
-            return os.getenv(env_var, value)
+            resolved = self._env_cache.get(value)
+            if resolved is None:
+                env_var = value.split(":", 1)[1]
+                resolved = self._env_cache[value] = os.getenv(env_var, value)
+            return resolved
         return value
 
     async def get_element_screenshot(self, selector: str, filename: str):
@@ -217,6 +338,17 @@ class PlaywrightEngine:
             logging.info(f"❌ Error taking element screenshot: {e}")
             return False
 
+    async def get_element_screenshot_bytes(self, selector: str) -> Optional[bytes]:
+        """Toma captura (PNG) de un elemento específico sin escribirla a disco."""
+        try:
+            element = await self.page.query_selector(selector)
+            if element:
+                return await element.screenshot()
+            return None
+        except Exception as e:
+            logging.info(f"❌ Error taking element screenshot: {e}")
+            return None
+
 # ... (keep existing methods)
 
     async def execute_action(self, action: Dict[str, Any], oracle=None):
@@ -226,7 +358,6 @@ class PlaywrightEngine:
             if act_type == "browse":
                 url = action.get("url")
                 logging.info(f"🌐 Navigating to {url}...")
-                logging.info(f"🌐 Navigating to {url}...")
                 await self.page.goto(url)
 
             elif act_type == "reload":
@@ -237,11 +368,15 @@ class PlaywrightEngine:
                 selector = action.get("element")
                 value = self._resolve_value(action.get("value", ""))
                 logging.info(f"⌨️ Typing into {selector}...")
+                await self.page.wait_for_selector(selector, state="visible")
                 await self.page.fill(selector, value)
 
             elif act_type == "click":
                 selector = action.get("element")
+                # A deferred captcha must be filled before submitting anything
+                await self.await_captcha()
                 logging.info(f"🖱️ Clicking {selector}...")
+                await self.page.wait_for_selector(selector, state="visible")
                 await self.page.click(selector)
             
             elif act_type == "wait":
@@ -249,41 +384,42 @@ class PlaywrightEngine:
                 logging.info(f"⏳ Waiting {duration}ms...")
                 await self.page.wait_for_timeout(duration)
 
+            elif act_type == "await_captcha":
+                await self.await_captcha()
+
             elif act_type == "solve_captcha":
                 img_selector = action.get("image_element")
                 input_selector = action.get("input_element")
                 
                 logging.info(f"🧩 Solving Captcha (Image: {img_selector})...")
                 
-                # Take screenshot of captcha (Save with timestamp for debugging)
-                # Take screenshot of captcha (Save with timestamp for debugging)
-                timestamp = int(time.time())
-                captcha_filename = f"captcha_{timestamp}.png"
-                processed_filename = f"captcha_{timestamp}_clean.png"
-                
-                captcha_file = os.path.join(self.output_dir, captcha_filename)
-                processed_file = os.path.join(self.output_dir, processed_filename)
+                # Take screenshot of captcha in memory
+                captcha_bytes = await self.get_element_screenshot_bytes(img_selector)
                 
-                if await self.get_element_screenshot(img_selector, captcha_file):
+                if captcha_bytes:
+                    # Preprocess Image (falls back to the raw capture)
+                    processed_bytes = self.process_image(captcha_bytes)
+                    target_bytes = processed_bytes or captcha_bytes
+
+                    # Save only the image sent to the solver (with timestamp for debugging)
+                    timestamp = int(time.time())
+                    captcha_filename = f"captcha_{timestamp}_clean.png" if processed_bytes else f"captcha_{timestamp}.png"
+                    captcha_file = os.path.join(self.output_dir, captcha_filename)
+                    await asyncio.to_thread(_write_file, captcha_file, target_bytes)
                     logging.info(f"   📸 Captcha image saved to {captcha_file}")
                     self.generated_files.append(captcha_file)
-                    
-                    # Preprocess Image
-                    if self.process_image(captcha_file, processed_file):
-                        target_file = processed_file
-                        self.generated_files.append(processed_file)
-                    else:
-                        target_file = captcha_file
 
                     # Use Anti-Captcha
-                    # Run in thread to avoid blocking loop (Anti-Captcha is sync)
-                    captcha_text = await asyncio.to_thread(self.captcha_solver.solve_image, target_file)
-                    
-                    if captcha_text:
-                         await self.page.fill(input_selector, captcha_text)
+                    # Run in thread to avoid blocking loop (Anti-Captcha is sync), as a Task
+                    # so later actions can overlap with the solver when "defer" is set
+                    self.cancel_pending_captcha()
+                    solve_task = asyncio.create_task(asyncio.to_thread(self.captcha_solver.solve_image, target_bytes))
+                    self._pending_captcha = (input_selector, solve_task)
+
+                    if action.get("defer"):
+                        logging.info("   ⏩ Captcha solving in background. Continuing...")
                     else:
-                        logging.error("⚠️ Failed to solve captcha (Text is empty/0). Raising exception to trigger retry.")
-                        raise Exception("Captcha Solve Failed")
+                        await self.await_captcha()
                 else:
                     logging.info(f"⚠️ Captcha image element not found: {img_selector}")
 
@@ -298,21 +434,27 @@ class PlaywrightEngine:
                 raise e
 
     async def take_screenshot(self, filename: str):
-        await self.page.screenshot(path=filename)
+        await self.page.screenshot(path=filename, type="jpeg", quality=SCREENSHOT_QUALITY)
+
+    async def take_screenshot_bytes(self) -> bytes:
+        """Toma captura de la página sin escribirla a disco."""
+        return await self.page.screenshot(type="jpeg", quality=SCREENSHOT_QUALITY)
     
-    def process_image(self, input_path: str, output_path: str):
-        """Pre-procesa la imagen para limpiar ruido."""
+    def process_image(self, image_data: bytes) -> Optional[bytes]:
+        """Pre-procesa la imagen (PNG en memoria) para limpiar ruido."""
         try:
-            img = Image.open(input_path).convert("L") # Grayscale
-            enhancer = ImageEnhance.Contrast(img)
-            img = enhancer.enhance(2.0)
-            img = img.point(lambda p: p > 150 and 255) 
-            img.save(output_path)
-            logging.info(f"   🖼️ Image processed and saved to {output_path}")
-            return True
+            arr = np.asarray(Image.open(io.BytesIO(image_data)).convert("L"), dtype=np.int16) # Grayscale
+            # Contraste x2 alrededor de la media (igual que ImageEnhance.Contrast) + umbral en una sola pasada
+            mean = int(arr.mean() + 0.5)
+            arr = np.where(mean + (arr - mean) * 2 > 150, 255, 0).astype(np.uint8)
+            output = io.BytesIO()
+            # compress_level=1: la codificación PNG es el paso más caro y la imagen es diminuta
+            Image.fromarray(arr).save(output, format="PNG", compress_level=1)
+            logging.info("   🖼️ Image processed")
+            return output.getvalue()
         except Exception as e:
             logging.info(f"❌ Error processing image: {e}")
-            return False
+            return None
 
 class SmartRetryLoop:
     """Maneja el bucle de intentos y validación."""
@@ -322,10 +464,16 @@ class SmartRetryLoop:
         self.oracle = Oracle()
         self.max_retries = 3
         self.generated_files = [] # Track validation screenshots
+        self.proof = None # (path, bytes) de la última validación exitosa; se escribe al final
+
+    async def save_screenshot(self, path: str, image_data: bytes):
+        """Persiste una captura en memoria y la registra para la limpieza final."""
+        await asyncio.to_thread(_write_file, path, image_data)
+        self.generated_files.append(path)
 
     def load_mission(self) -> List[List[Dict]]:
-        with open(self.mission_file, "r") as f:
-            return json.load(f)
+        with open(self.mission_file, "rb") as f:
+            return orjson.loads(f.read())
 
     async def run(self):
         mission_steps = self.load_mission()
@@ -337,6 +485,7 @@ class SmartRetryLoop:
                 
                 success = False
                 attempts = 0
+                failed_screenshots = [] # Solo se escriben a disco si el paso falla
 
                 while not success and attempts < self.max_retries:
                     attempts += 1
@@ -370,22 +519,19 @@ class SmartRetryLoop:
                                     logging.info(f"   ⏳ Polling validation ({val_attempt}/{max_val_attempts})... waiting {polling_delay}s")
                                     await asyncio.sleep(polling_delay)
 
-                                    logging.info(f"   ⏳ Polling validation ({val_attempt}/{max_val_attempts})... waiting {polling_delay}s")
-                                    await asyncio.sleep(polling_delay)
-
-                                screenshot_filename = f"step_{step_index}_attempt_{attempts}_val_{val_attempt}.png"
+                                screenshot_filename = f"step_{step_index}_attempt_{attempts}_val_{val_attempt}.jpg"
                                 screenshot_path = os.path.join(self.engine.output_dir, screenshot_filename)
                                 
-                                await self.engine.take_screenshot(screenshot_path)
-                                self.generated_files.append(screenshot_path)
-                                
-                                verdict = await self.oracle.validate(screenshot_path, validation_prompt)
+                                screenshot_bytes = await self.engine.take_screenshot_bytes()
+                                verdict = await self.oracle.validate_bytes(screenshot_bytes, validation_prompt)
                                 
                                 if verdict.get("passed"):
                                     logging.info("✅ Validation Passed!")
                                     success = True
+                                    self.proof = (screenshot_path, screenshot_bytes)
                                 else:
                                     logging.info(f"🛑 Validation Failed: {verdict.get('reason')}")
+                                    failed_screenshots.append((screenshot_path, screenshot_bytes))
                             
                             if not success and attempts < self.max_retries:
                                 logging.info("   ⚠️ Step failed after validation polling. Retrying actions in 5s...")
@@ -400,11 +546,17 @@ class SmartRetryLoop:
                             await asyncio.sleep(5)
 
                 if not success:
+                    for path, image_data in failed_screenshots:
+                        await self.save_screenshot(path, image_data)
                     logging.info(f"💀 CRITICAL FAILURE: Step {step_index + 1} failed after {self.max_retries} attempts.")
                     break
         
         finally:
             await self.engine.stop()
+
+            # Persist only the final proof of a successful mission
+            if success and self.proof:
+                await self.save_screenshot(*self.proof)
             
             # Cleanup Logic
             all_files = self.engine.generated_files + self.generated_files
@@ -413,13 +565,7 @@ class SmartRetryLoop:
                 # Keep only the last generated file (assuming it's the success proof)
                 if all_files:
                     last_file = all_files[-1]
-                    for f in all_files:
-                        if f != last_file and os.path.exists(f):
-                            try:
-                                os.remove(f)
-                                logging.info(f"   Deleted {f}")
-                            except Exception as e:
-                                logging.error(f"   Failed to delete {f}: {e}")
+                    await asyncio.to_thread(_bulk_delete, [f for f in all_files if f != last_file])
                     logging.info(f"✨ Kept final proof: {last_file}")
             else:
                 logging.info("📝 Mission Failed. Keeping all screenshots for debugging.")
@@ -66,6 +66,7 @@ SEQUENCES = [
         "intents_number": 3,
         "target_element": "ibp-quick-access",
         "target_element_wait": 5,
+        "persist_session": True,
         "steps": [
             {
                 "action": "navigate",
@@ -216,6 +217,8 @@ async def main():
                     
     except Exception as e:
         print(f"🔥 CRITICAL ERROR: {e}")
+    finally:
+        await SequenceExecutor.close_browser()
     
     print("\n----------------------------------------")
     input("Press Enter to exit...")
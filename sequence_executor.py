@@ -1,13 +1,18 @@
 import asyncio
-import json
+import anyio
+import orjson
 import os
+import sys
+import random
 import time
 import logging
-import uuid
 import datetime
 import traceback
+from collections import deque
 from dotenv import load_dotenv
-from automaton import PlaywrightEngine
+from typing import Optional
+from playwright.async_api import Browser, async_playwright
+from automaton import PlaywrightEngine, SCREENSHOT_QUALITY, launch_browser, session_state_path
 
 # Setup Logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -15,32 +20,238 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # Load Environment
 load_dotenv()
 
+# Final execution screenshots folder, created once at import
+_SCREENSHOTS_DIR = os.path.join(os.getcwd(), "screenshots")
+os.makedirs(_SCREENSHOTS_DIR, exist_ok=True)
+
+# Log lines kept per execution; older lines are dropped once the limit is reached
+MAX_LOG_LINES = 10000
+
+# Resolved "env:" step values, read from the environment once per process
+_ENV_CACHE = {}
+
+# Pretty-print the standalone run's JSON result (compact otherwise)
+DEBUG = os.getenv("DEBUG", "false").lower() == "true"
+
+# Final execution screenshot covers the whole page only when debugging
+SCREENSHOT_FULL_PAGE = os.getenv("SCREENSHOT_FULL_PAGE", "false").lower() == "true"
+
+# Retry cooldown between sequence attempts: base * 2^(attempt-1), capped, plus up to 50% jitter
+RETRY_BACKOFF_BASE = 1.0
+RETRY_BACKOFF_MAX = 30
+
+# Adaptive post-step wait: poll the DOM size every DOM_POLL_INTERVAL seconds and, once it
+# differs from its size before the step, stop when it has been unchanged for
+# DOM_STABLE_WINDOW seconds (or wait_after runs out)
+DOM_POLL_INTERVAL = 0.1
+DOM_STABLE_WINDOW = 0.3
+
+# Seconds a page.is_visible() result is reused for the same page/URL/selector
+VISIBILITY_CACHE_TTL = 0.5
+
 class SequenceExecutor:
-    def __init__(self):
-        self.logs = []
-        self.screenshots_dir = os.path.join(os.getcwd(), "screenshots")
-        if not os.path.exists(self.screenshots_dir):
-            os.makedirs(self.screenshots_dir)
+    # Process-wide Playwright/Browser, launched on first use and reused by every execution
+    _shared_playwright = None
+    _shared_browser: Optional[Browser] = None
+    _shared_lock: Optional[asyncio.Lock] = None
+
+    def __init__(self, browser: Optional[Browser] = None):
+        # Optional Browser override; defaults to the shared one (see get_browser)
+        self.browser = browser
+        self.logs = deque(maxlen=MAX_LOG_LINES)
+        self.log_queue = None # Set by execute_stream; log lines go here instead of self.logs
+        self._last_ts_sec = 0
+        self._last_ts_str = ""
+        self._visibility_cache = {} # (page id, url, selector) -> (visible, monotonic timestamp)
+        # Step action -> handler(engine, step, data, coordinates)
+        self._handlers = {
+            "navigate": self._do_navigate,
+            "input": self._do_input,
+            "click": self._do_click,
+            "captcha": self._do_captcha,
+            "await_captcha": self._do_await_captcha,
+            "wait": self._do_wait,
+            "dynamic_input": self._do_dynamic_input,
+        }
+        self.screenshots_dir = _SCREENSHOTS_DIR
+
+    @classmethod
+    async def get_browser(cls) -> Browser:
+        """
+        Returns the process-wide Browser, launching it on first use (or again
+        if it got disconnected). Executions only open/close their own context.
+        """
+        if cls._shared_lock is None:
+            cls._shared_lock = asyncio.Lock()
+        async with cls._shared_lock:
+            if cls._shared_browser is None or not cls._shared_browser.is_connected():
+                if cls._shared_playwright is None:
+                    cls._shared_playwright = await async_playwright().start()
+                cls._shared_browser = await launch_browser(cls._shared_playwright)
+                logging.info("🌐 Shared browser ready.")
+            return cls._shared_browser
+
+    @classmethod
+    async def close_browser(cls):
+        """Closes the process-wide Browser and Playwright, if they were started."""
+        if cls._shared_browser:
+            await cls._shared_browser.close()
+            cls._shared_browser = None
+        if cls._shared_playwright:
+            await cls._shared_playwright.stop()
+            cls._shared_playwright = None
 
     def log(self, message: str, level: str = "INFO"):
         """Logs a message to the internal list and standard logger."""
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        formatted_message = f"[{timestamp}] {level}: {message}"
-        self.logs.append(formatted_message)
+        # Format the timestamp at most once per second
+        now = int(time.time())
+        if now != self._last_ts_sec:
+            self._last_ts_sec = now
+            self._last_ts_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now))
+        formatted_message = f"[{self._last_ts_str}] {level}: {message}"
+        if self.log_queue is not None:
+            self.log_queue.put_nowait(formatted_message)
+        else:
+            self.logs.append(formatted_message)
         if level == "ERROR":
             logging.error(message)
         else:
             logging.info(message)
 
+    async def is_visible_cached(self, engine: PlaywrightEngine, selector: str) -> bool:
+        """
+        page.is_visible with a short-lived cache, so repeated probes of the same
+        selector on the same page skip the CDP round-trip.
+        """
+        key = (id(engine.page), engine.page.url, selector)
+        cached = self._visibility_cache.get(key)
+        now = time.monotonic()
+        if cached and now - cached[1] < VISIBILITY_CACHE_TTL:
+            return cached[0]
+        visible = await engine.page.is_visible(selector)
+        self._visibility_cache[key] = (visible, now)
+        return visible
+
+    async def dom_length(self, engine: PlaywrightEngine) -> Optional[int]:
+        """Current outerHTML length of the page, or None while a navigation is in progress."""
+        try:
+            return await engine.page.evaluate("document.documentElement.outerHTML.length")
+        except Exception:
+            return None
+
+    async def adaptive_wait(self, engine: PlaywrightEngine, max_wait: float, baseline: Optional[int]) -> float:
+        """
+        Waits up to max_wait seconds, returning early once the DOM size differs from
+        baseline (taken before the step ran) and has then not changed for
+        DOM_STABLE_WINDOW seconds. Returns the time actually waited.
+        """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        deadline = start + max_wait
+        last_length = None
+        stable_since = start
+        changed = False
+
+        while loop.time() < deadline:
+            length = await self.dom_length(engine)
+            now = loop.time()
+            # A page the step never changed is not "settled": its update may still be on the way
+            changed = changed or length != baseline
+            if length is None or length != last_length:
+                last_length = length
+                stable_since = now
+            elif changed and now - stable_since >= DOM_STABLE_WINDOW:
+                break
+            await asyncio.sleep(max(0, min(DOM_POLL_INTERVAL, deadline - loop.time())))
+
+        return loop.time() - start
+
     def resolve_data(self, data):
         """
         Resolves a data string that might contain environment variable references.
         """
         if data and isinstance(data, str) and data.startswith("env:"):
-            env_key = data.split("env:")[1]
-            return os.getenv(env_key, "")
+            env_key = data[4:]
+            value = _ENV_CACHE.get(env_key)
+            if value is None:
+                value = _ENV_CACHE[env_key] = os.getenv(env_key, "")
+            return value
         return data
 
+    async def _do_navigate(self, engine: PlaywrightEngine, step: dict, data, coordinates: dict):
+        current_url = engine.page.url.rstrip('/')
+        target_url = step.get("_target_url") or data.rstrip('/')
+        # Cached visibility belongs to the page being replaced (a same-URL reload keeps the cache key)
+        self._visibility_cache.clear()
+        
+        if current_url == target_url:
+            self.log(f"   🔄 Already on {target_url}. Forcing RELOAD to reset state...")
+            # Only the reset matters here; later steps wait for their selectors (captcha for domcontentloaded)
+            await engine.page.reload(wait_until="commit")
+        else:
+            await engine.page.goto(data, wait_until="domcontentloaded")
+
+    async def _do_input(self, engine: PlaywrightEngine, step: dict, data, coordinates: dict):
+        # .first keeps the non-strict "first match" behaviour of the page.* methods
+        locator = engine.page.locator(step.get("element")).first
+        # fill("") auto-waits for the field, clears and focuses it in one call; then type like a user
+        await locator.fill("", timeout=2000)
+        await engine.page.keyboard.type(data, delay=50)
+
+    async def _do_click(self, engine: PlaywrightEngine, step: dict, data, coordinates: dict):
+        # The deferred captcha was already filled by process_steps
+        # One locator: the selector is resolved once for the wait and the click
+        locator = engine.page.locator(step.get("element")).first
+        await locator.wait_for(state="visible", timeout=2000)
+        await locator.click()
+
+    async def _do_captcha(self, engine: PlaywrightEngine, step: dict, data, coordinates: dict):
+        # A commit-level reload may not have parsed the page yet; returns at once if it has
+        await engine.page.wait_for_load_state("domcontentloaded")
+        captcha_visible = await self.is_visible_cached(engine, data)
+        
+        if captcha_visible:
+            self.log(f"   🧩 Captcha detected ({data}). Solving...")
+            captcha_action = {
+                "action": "solve_captcha",
+                "image_element": data,
+                "input_element": step.get("element"),
+                "defer": step.get("defer", False)
+            }
+            await engine.execute_action(captcha_action)
+        else:
+            self.log(f"   ℹ️ Captcha NOT detected ({data}). Skipping step.")
+
+    async def _do_await_captcha(self, engine: PlaywrightEngine, step: dict, data, coordinates: dict):
+        await engine.await_captcha()
+
+    async def _do_wait(self, engine: PlaywrightEngine, step: dict, data, coordinates: dict):
+        pass
+
+    async def _do_dynamic_input(self, engine: PlaywrightEngine, step: dict, data, coordinates: dict):
+        lookup_source = step.get("lookup_source", "coordinates.json") # Just for reference in logs if needed, but we use passed coordinates
+        read_locator = engine.page.locator(data).first
+        write_locator = engine.page.locator(step.get("element")).first
+
+        # 1. Read key from page
+        await read_locator.wait_for(state="visible", timeout=5000)
+        raw_text = await read_locator.inner_text()
+        # Numeric keys drop zero padding ("05" -> "5"); anything else is used as-is
+        stripped = raw_text.strip()
+        key = str(int(stripped)) if stripped.isdecimal() else stripped
+        
+        self.log(f"   🔑 Challenge Key Detected: '{key}' (Raw: '{raw_text}')")
+
+        # 2. Lookup Value from provided coordinates
+        value = coordinates.get(key)
+        if value:
+            self.log(f"   ✅ Value Found: {value}")
+            # 3. Write Value
+            # fill auto-waits for the field to be visible and editable
+            await write_locator.fill(value, timeout=5000)
+        else:
+             raise Exception(f"Key '{key}' not found in provided coordinates")
+
     async def process_steps(self, engine: PlaywrightEngine, steps: list, coordinates: dict):
         """
         Iterates through a list of steps and executes them.
@@ -52,74 +263,35 @@ class SequenceExecutor:
             wait_after = step.get("wait_after", 1)
             optional = step.get("optional", False)
             
+            handler = self._handlers.get(action)
+            if handler is None:
+                self.log(f"   ⚠️ Unknown action '{action}'. Skipping step.", "WARNING")
+                continue
+
             self.log(f"➡️ Executing Step: {action} on {element or 'N/A'} (Optional: {optional})")
+
+            # Fill any captcha still solving in the background before clicking.
+            # Outside the try: a failed solve fails the attempt even if the click is optional
+            if action == "click":
+                await engine.await_captcha()
             
             try:
-                if action == "navigate":
-                    current_url = engine.page.url.rstrip('/')
-                    target_url = data.rstrip('/')
-                    
-                    if current_url == target_url:
-                        self.log(f"   🔄 Already on {target_url}. Forcing RELOAD to reset state...")
-                        await engine.page.reload(wait_until="domcontentloaded")
-                    else:
-                        await engine.page.goto(data, wait_until="domcontentloaded")
-                    
-                elif action == "input":
-                    await engine.page.wait_for_selector(element, state="visible", timeout=2000)
-                    await engine.page.click(element)
-                    await engine.page.keyboard.press("Control+A")
-                    await engine.page.keyboard.press("Backspace")
-                    await engine.page.keyboard.type(data, delay=50)
-                        
-                elif action == "click":
-                    timeout = 2000 if optional else 2000
-                    await engine.page.wait_for_selector(element, state="visible", timeout=timeout)
-                    await engine.page.click(element)
-                    
-                elif action == "captcha":
-                    captcha_visible = await engine.page.is_visible(data)
-                    
-                    if captcha_visible:
-                        self.log(f"   🧩 Captcha detected ({data}). Solving...")
-                        captcha_action = {
-                            "action": "solve_captcha",
-                            "image_element": data,
-                            "input_element": element
-                        }
-                        await engine.execute_action(captcha_action)
-                    else:
-                        self.log(f"   ℹ️ Captcha NOT detected ({data}). Skipping step.")
-                    
-                elif action == "wait":
-                    pass
-                    
-                elif action == "dynamic_input":
-                    lookup_source = step.get("lookup_source", "coordinates.json") # Just for reference in logs if needed, but we use passed coordinates
-                    read_selector = data
-                    write_selector = element
-
-                    # 1. Read key from page
-                    await engine.page.wait_for_selector(read_selector, state="visible", timeout=5000)
-                    raw_text = await engine.page.inner_text(read_selector)
-                    key = raw_text.strip().replace("0", "") if raw_text.startswith("0") and len(raw_text) == 2 else raw_text.strip()
-                    
-                    self.log(f"   🔑 Challenge Key Detected: '{key}' (Raw: '{raw_text}')")
-
-                    # 2. Lookup Value from provided coordinates
-                    value = coordinates.get(key)
-                    if value:
-                        self.log(f"   ✅ Value Found: {value}")
-                        # 3. Write Value
-                        await engine.page.wait_for_selector(write_selector, state="visible", timeout=5000)
-                        await engine.page.fill(write_selector, value)
-                    else:
-                         raise Exception(f"Key '{key}' not found in provided coordinates")
+                # DOM size before the step, so the adaptive wait can tell when the step changed the page
+                baseline = None
+                if wait_after > 0 and action != "wait":
+                    baseline = await self.dom_length(engine)
 
-                # Handle post-step wait
+                await handler(engine, step, data, coordinates)
+
+                # Handle post-step wait: explicit waits sleep in full, the rest end once the page settles
                 if wait_after > 0:
-                    self.log(f"   ⏳ Waiting {wait_after}s...")
-                    await asyncio.sleep(wait_after)
+                    if action == "wait":
+                        self.log(f"   ⏳ Waiting {wait_after}s...")
+                        await asyncio.sleep(wait_after)
+                    else:
+                        self.log(f"   ⏳ Waiting up to {wait_after}s for the page to settle...")
+                        waited = await self.adaptive_wait(engine, wait_after, baseline)
+                        self.log(f"   ⏳ Page settled after {waited:.1f}s.")
 
             except Exception as e:
                 if optional:
@@ -128,6 +300,42 @@ class SequenceExecutor:
                     self.log(f"❌ Error in step {action}: {e}", "ERROR")
                     raise e
 
+    def session_file(self, sequence: dict) -> str:
+        """
+        Session state file for a persist_session sequence. Keyed on its title and the
+        values its input steps type (e.g. resolved env: credentials), so each identity
+        only ever restores its own login.
+        """
+        typed = [str(self.resolve_data(step.get("data")) or "") for step in sequence.get("steps", []) if step.get("action") == "input"]
+        return session_state_path("\0".join([sequence.get("title") or "", *typed]))
+
+    async def check_session(self, engine: PlaywrightEngine, steps: list, target: str, target_wait: float):
+        """
+        Checks whether a restored session is still logged in by opening the
+        sequence's first URL and looking for its target element.
+        """
+        self.log("   🍪 Restored session found. Checking if it is still valid...")
+        first_url = next((step.get("data") for step in steps if step.get("action") == "navigate"), None)
+        try:
+            if first_url:
+                await engine.page.goto(first_url, wait_until="domcontentloaded")
+            await engine.page.wait_for_selector(target, state="visible", timeout=int(target_wait * 1000))
+            self.log(f"   ✅ SUCCESS: Session still valid, target '{target}' found. Skipping sequence.")
+            return True
+        except Exception:
+            self.log("   ⚠️ Restored session is no longer valid. Running sequence...", "WARNING")
+            # Drop the stale file so the next runs don't pay for this check again
+            await engine.discard_session()
+            return False
+
+    async def save_session(self, engine: PlaywrightEngine, session_file: str):
+        """Persists the browser session so later executions can skip this sequence."""
+        try:
+            await engine.save_session(session_file)
+            self.log("   🍪 Session saved for reuse.")
+        except Exception as e:
+            self.log(f"   ⚠️ Failed to save session: {e}", "WARNING")
+
     async def process_sequence(self, engine: PlaywrightEngine, sequence: dict, coordinates: dict):
         """Processes a single sequence with retries."""
         title = sequence.get("title")
@@ -135,11 +343,18 @@ class SequenceExecutor:
         target = sequence.get("target_element")
         target_wait = sequence.get("target_element_wait", 0)
         steps = sequence.get("steps", [])
+        session_file = self.session_file(sequence) if sequence.get("persist_session") else None
         
         self.log(f"🎬 SELECTING SEQUENCE: {title} (Max Intents: {intents})")
+
+        if session_file and target and engine.session_restored and engine.session_file == session_file:
+            if await self.check_session(engine, steps, target, target_wait):
+                return True
         
         for attempt in range(1, intents + 1):
             self.log(f"   🔄 Attempt {attempt}/{intents}")
+            # A deferred captcha left by a failed attempt belongs to a page that is gone
+            engine.cancel_pending_captcha()
             try:
                 await self.process_steps(engine, steps, coordinates)
                 
@@ -148,38 +363,98 @@ class SequenceExecutor:
                     try:
                         await engine.page.wait_for_selector(target, state="visible", timeout=int(target_wait * 1000))
                         self.log(f"   ✅ SUCCESS: Target '{target}' found.")
+                        if session_file:
+                            await self.save_session(engine, session_file)
                         return True
                     except Exception:
                         self.log(f"   ⚠️ FAILURE: Target '{target}' NOT found after attempt {attempt}.", "WARNING")
                 else:
                     self.log("   ✅ SUCCESS: Sequence completed (no target defined).")
+                    if session_file:
+                        await self.save_session(engine, session_file)
                     return True
                     
             except Exception as e:
                 self.log(f"   ❌ EXCEPTION: {e}", "ERROR")
                 
             if attempt < intents:
-                self.log("   ♻️ Retrying...")
-                await asyncio.sleep(2)
+                # Exponential backoff with jitter; no wait after the final attempt
+                delay = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * (2 ** (attempt - 1))) * (1 + random.uniform(0, 0.5))
+                self.log(f"   ♻️ Retrying in {delay:.1f}s...")
+                await asyncio.sleep(delay)
                 
         self.log(f"🛑 SEQUENCE FAILED: {title} failed after {intents} attempts.", "ERROR")
         return False
 
+    @staticmethod
+    def prepare_sequences(sequences: list):
+        """
+        Pre-computes step values that only depend on the static sequence
+        definition, once per execution instead of once per step attempt.
+        """
+        for seq in sequences:
+            for step in seq.get("steps", []):
+                data = step.get("data")
+                if step.get("action") == "navigate" and data and not data.startswith("env:"):
+                    step["_target_url"] = data.rstrip('/')
+
+    @staticmethod
+    def group_sequences(sequences: list) -> list:
+        """
+        Splits sequences into run groups. Consecutive sequences sharing the same
+        'parallel_group' form one group; every other sequence runs on its own.
+        """
+        groups = []
+        for seq in sequences:
+            parallel_group = seq.get("parallel_group")
+            if parallel_group and groups and groups[-1][0].get("parallel_group") == parallel_group:
+                groups[-1].append(seq)
+            else:
+                groups.append([seq])
+        return groups
+
+    async def process_parallel_group(self, engine: PlaywrightEngine, group: list, coordinates: dict):
+        """
+        Runs a group of independent sequences concurrently, each one in its own
+        browser context on the same Browser. Succeeds only if all of them succeed.
+        """
+        self.log(f"🔀 PARALLEL GROUP: {group[0].get('parallel_group')} ({len(group)} sequences)")
+
+        # Every context starts from the current session (cookies/localStorage)
+        storage_state = await engine.context.storage_state()
+        engines = [PlaywrightEngine(browser=engine.browser) for _ in group]
+        try:
+            await asyncio.gather(*[e.start(storage_state=storage_state) for e in engines])
+            results = await asyncio.gather(*[
+                self.process_sequence(e, seq, coordinates) for e, seq in zip(engines, group)
+            ])
+            return all(results)
+        finally:
+            await asyncio.gather(*[e.stop() for e in engines], return_exceptions=True)
+
     async def execute(self, sequences: list, coordinates: dict):
         """
         Executes the list of sequences.
         Returns a dictionary with result, logs, and screenshot filename.
         """
-        self.logs = [] # Reset logs
-        engine = PlaywrightEngine()
+        self.logs = deque(maxlen=MAX_LOG_LINES) # Reset logs
+        engine = None
         success = True
         
         try:
-            await engine.start()
+            self.prepare_sequences(sequences)
+            # Fresh context per execution on the reused Browser (no launch cost, no shared state).
+            # Only a sequence that opted into persist_session gets its own saved login back.
+            session_file = next((self.session_file(seq) for seq in sequences if seq.get("persist_session")), None)
+            engine = PlaywrightEngine(browser=self.browser or await self.get_browser())
+            await engine.start(session_file=session_file)
             start_time = time.time()
             
-            for seq in sequences:
-                seq_success = await self.process_sequence(engine, seq, coordinates)
+            for group in self.group_sequences(sequences):
+                if len(group) == 1:
+                    seq_success = await self.process_sequence(engine, group[0], coordinates)
+                else:
+                    seq_success = await self.process_parallel_group(engine, group, coordinates)
                 if not seq_success:
                     self.log("💀 FLOW ABORTED: Critical sequence failed.", "ERROR")
                     success = False
@@ -197,40 +472,78 @@ class SequenceExecutor:
         finally:
             # Capture Screenshot
             timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            unique_id = uuid.uuid4()
-            screenshot_filename = f"execution_{timestamp}_{unique_id}.png"
+            unique_id = os.urandom(8).hex()
+            screenshot_filename = f"execution_{timestamp}_{unique_id}.jpg"
             screenshot_path = os.path.join(self.screenshots_dir, screenshot_filename)
             
             try:
-                await engine.page.screenshot(path=screenshot_path)
+                if engine is None or engine.page is None:
+                    raise RuntimeError("browser was not started")
+                await engine.page.screenshot(
+                    path=screenshot_path,
+                    type="jpeg",
+                    quality=SCREENSHOT_QUALITY,
+                    full_page=SCREENSHOT_FULL_PAGE
+                )
                 self.log(f"📸 Screenshot saved: {screenshot_filename}")
             except Exception as e:
                 self.log(f"❌ Failed to take screenshot: {e}", "ERROR")
                 screenshot_filename = None # Indicator of failure to screenshot
-
-            try:
-                await engine.stop()
-            except Exception as e:
-                self.log(f"⚠️ Error stopping engine (likely already closed): {e}", "WARNING")
+            finally:
+                # Close the context even if the screenshot was cancelled, so it doesn't leak on the shared Browser
+                try:
+                    if engine:
+                        await engine.stop()
+                except Exception as e:
+                    self.log(f"⚠️ Error stopping engine (likely already closed): {e}", "WARNING")
 
         return {
             "success": success,
-            "logs": self.logs,
+            "logs": list(self.logs),
             "screenshot": screenshot_filename
         }
 
+    async def execute_stream(self, sequences: list, coordinates: dict):
+        """
+        Same as execute, but yields events as the flow progresses instead of
+        buffering the logs: one {"log": ...} per log line and a final
+        {"result": {"success": ..., "screenshot": ...}}.
+        """
+        queue = self.log_queue = asyncio.Queue()
+        task = asyncio.create_task(self.execute(sequences, coordinates))
+        task.add_done_callback(lambda _: queue.put_nowait(None))
+        try:
+            while (message := await queue.get()) is not None:
+                yield {"log": message}
+            result = task.result()
+            yield {"result": {"success": result["success"], "screenshot": result["screenshot"]}}
+        finally:
+            # Client went away mid-flow: stop the execution and wait for its finally
+            # (screenshot + context close) so the caller's execution slot stays held until then.
+            # Shielded: Starlette keeps re-cancelling this task on disconnect, and awaiting
+            # the task directly would forward that cancellation into its teardown.
+            if not task.done():
+                task.cancel()
+                with anyio.CancelScope(shield=True):
+                    await asyncio.wait([task])
+            self.log_queue = None
+
 async def main():
     # 1. Load Sequences
-    with open("sequences.json", "r", encoding="utf-8") as f:
-        sequences = json.load(f)
+    with open("sequences.json", "rb") as f:
+        sequences = orjson.loads(f.read())
     
     # Load coordinates (mocking what would be passed via API, but reading from file for standalone)
-    with open("coordinates.json", "r", encoding="utf-8") as f:
-        coordinates = json.load(f)
+    with open("coordinates.json", "rb") as f:
+        coordinates = orjson.loads(f.read())
         
     executor = SequenceExecutor()
-    result = await executor.execute(sequences, coordinates)
-    print(json.dumps(result, indent=2))
+    try:
+        result = await executor.execute(sequences, coordinates)
+    finally:
+        await SequenceExecutor.close_browser()
+    option = orjson.OPT_APPEND_NEWLINE | (orjson.OPT_INDENT_2 if DEBUG else 0)
+    sys.stdout.buffer.write(orjson.dumps(result, option=option))
 
 if __name__ == "__main__":
     asyncio.run(main())
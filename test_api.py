@@ -1,16 +1,19 @@
 import requests
-import json
+import orjson
 import time
 
+# Reused across calls so repeated runs keep the same TCP connection
+session = requests.Session()
+
 def test_api():
     url = "http://localhost:8080/execute"
     
     # Load data from local files to construct payload
     try:
-        with open("sequences.json", "r", encoding="utf-8") as f:
-            sequences = json.load(f)
-        with open("coordinates.json", "r", encoding="utf-8") as f:
-            coordinates = json.load(f)
+        with open("sequences.json", "rb") as f:
+            sequences = orjson.loads(f.read())
+        with open("coordinates.json", "rb") as f:
+            coordinates = orjson.loads(f.read())
     except FileNotFoundError:
         print("Error: sequences.json or coordinates.json not found.")
         return
@@ -23,7 +26,7 @@ def test_api():
     print(f"Sending request to {url}...")
     try:
         start_time = time.time()
-        response = requests.post(url, json=payload, timeout=300) # Long timeout for browser automation
+        response = session.post(url, json=payload, timeout=300) # Long timeout for browser automation
         end_time = time.time()
         
         print(f"Response Status: {response.status_code}")
@@ -35,7 +38,7 @@ def test_api():
             print("Screenshot:", data.get("screenshot"))
             print("Logs count:", len(data.get("logs")))
             if not data.get("success"):
-                print("Logs:", json.dumps(data.get("logs"), indent=2))
+                print("Logs:", orjson.dumps(data.get("logs"), option=orjson.OPT_INDENT_2).decode())
         else:
             print("Error Response:", response.text)
             